@@ -22,93 +22,227 @@ __email__ = "luminosity@freemre.com"
 __discord__ = "luminosity#6969"
 
 import bpy
+import bmesh
 import sys
 import os
 import re
 import json
+import shutil
 import logging
 import argparse
+import numpy as np
 from enum import Enum
+from functools import lru_cache, partial
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha256
 
+try:
+    # optional, reads and writes textures without blender images
+    import cv2
+except ImportError:
+    cv2 = None
+
 logging.basicConfig(level=logging.DEBUG)
 
 
-# global
-models = sorted(os.listdir('Models'))
-textures = sorted(os.listdir('Textures'))
-eyes = sorted(os.listdir('Textures/eyes'))
-mouths = sorted(os.listdir('Textures/mouths'))
-colors = {}
+def loadManifest(filepath):
+    try:
+        with open(filepath) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+@lru_cache(maxsize=None)
+def getManifest():
+    """
+    :return: directory listings from previous runs, loaded on first use
+    """
+    return loadManifest(manifest_path)
+
+
+def listDir(dir):
+    """
+    :param dir: directory to list
+    :return: sorted filenames, reused from the manifest
+        until the directory is modified
+    """
+    manifest = getManifest()
+    mtime = os.stat(dir).st_mtime_ns
+    entry = manifest.get(dir)
+    if entry and entry['mtime'] == mtime:
+        return entry['entries']
+
+    entries = sorted(e.name for e in os.scandir(dir))
+    manifest[dir] = {'mtime': mtime, 'entries': entries}
+    changedListings.add(dir)
+    return entries
+
 
+def saveManifest():
+    """
+    Write the manifest if any listing changed during the run
+    """
+    if not changedListings:
+        return
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    # write then rename, concurrent batch runs share the manifest
+    tmpFilepath = '%s.%d' % (manifest_path, os.getpid())
+    with open(tmpFilepath, 'w') as f:
+        json.dump(getManifest(), f)
+    os.replace(tmpFilepath, manifest_path)
+    changedListings.clear()
+
+
+# global
 pi = 3.14159265
 tmp_dir = 'tmp'
+# preview camera, precomputed so it is assigned in one go
+camera_rotation = (90*(pi/180.0), 0.0, 0.0)
+camera_location = (-0.021513, -2.7, 1.36731)
+
+manifest_path = os.path.join(tmp_dir, 'manifest.json')
+# directories listed again this run, saved by saveManifest
+changedListings = set()
+colors = {}
+# images modified in place, saved by saveImages
+dirtyImages = set()
+# pixels by filepath, shared by blend and overlay,
+# images in dirtyImages stay until saveImages writes them
+loadedImages = {}
+# thread pool of the running blendThreads block, if any
+blendExecutor = None
+# blend filepath => future, texture nodes waiting for it
+pendingBlends = {}
+pendingTextures = []
+
+# selection values use spaces where filenames use underscores
+space_to_underscore = str.maketrans(' ', '_')
+
+# name variations tried by the find functions
+trailing_number_re = re.compile(r'_00\d')
+first_word_re = re.compile(r'^[A-Za-z]+_')
+variant_re = re.compile(r'^Variant_')
+last_word_re = re.compile(r'_[a-zA-Z]+$')
+
+# eye brow special cases, replaced in a single pass,
+# composite keys give the same result as the replacements chained
+eyebrow_replacements = {
+    'Eyebrow_01': '001',
+    'Eyebrow_': '',
+    'Angled_001': 'EyeBrow_Angled_001',
+    'Angled_01': 'EyeBrow_Angled_001',
+    'ThickFlat_001': 'ThickFlat',
+    'ThickFlat_01': 'ThickFlat',
+    'Arched_Thick': 'ArchBushy',
+    'Arched_Medium': 'ArchHigh',
+    '_01': '_001',
+}
+eyebrow_re = re.compile('|'.join(map(re.escape, eyebrow_replacements)))
 
 
 def isSelected(v):
     return not v.startswith("No_")
 
 
-def match(filename, value):
+def normalize(filename):
     """
     :param filename: string
-    :param value: string
-    :return: boolean true if a contains b false otherwise
+    :return: filename without extension, spaces replaced by underscores, lower case
     """
     return \
-        value.lower() \
-        in \
         filename.replace('.fbx', '')\
         .replace('.png', '')\
         .replace(' ', '_')\
         .lower()
 
 
+def match(filename, value):
+    """
+    :param filename: string
+    :param value: string
+    :return: boolean true if a contains b false otherwise
+    """
+    return value.lower() in normalize(filename)
+
+
+def buildIndex(filenames):
+    """
+    :param filenames: list of filenames
+    :return: list of (normalized filename, filename) tuples
+    """
+    return [(normalize(f), f) for f in filenames]
+
+
+def matchIndex(index, value):
+    """
+    :param index: list of (normalized filename, filename) tuples
+    :param value: string
+    :return: filenames which contain value
+    """
+    value = value.lower()
+    return [f for key, f in index if value in key]
+
+
+# filenames are normalized once instead of on every lookup
+@lru_cache(maxsize=None)
+def getIndex(dir):
+    """
+    :param dir: directory of the models or textures
+    :return: index of the directory, listed on first use
+    """
+    return buildIndex(listDir(dir))
+
+
+# left and right parts look up the same names
+@lru_cache(maxsize=None)
 def findModel(v):
-    files = models
+    index = getIndex('Models')
     # substring match
-    matches = list(filter(lambda m: match(m, v), files))
+    matches = matchIndex(index, v)
     if len(matches) > 0:
         return matches
 
     # try removing trailing _001
-    v1 = re.sub(r'_00\d', '', v)
-    matches = list(filter(lambda m: match(m, v1), files))
+    v1 = trailing_number_re.sub('', v)
+    matches = matchIndex(index, v1)
     if len(matches) > 0:
         return matches
 
     # try replacing first word with geo
-    v2 = "Geo_"+re.sub(r'^[A-Za-z]+_', '', v)
-    matches = list(filter(lambda m: match(m, v2), files))
+    v2 = "Geo_"+first_word_re.sub('', v)
+    matches = matchIndex(index, v2)
     if len(matches) > 0:
         return matches
 
     # try replacing first word with ''
-    v3 = re.sub(r'^[A-Za-z]+_', '', v)
-    matches = list(filter(lambda m: match(m, v3), files))
+    v3 = first_word_re.sub('', v)
+    matches = matchIndex(index, v3)
     if len(matches) > 0:
         return matches
 
     return []
 
 
+@lru_cache(maxsize=None)
 def findTexture(v):
-    files = textures
+    index = getIndex('Textures')
     v = v.replace('_HatHair', '')
     # substring match
-    matches = list(filter(lambda m: match(m, v), files))
+    matches = matchIndex(index, v)
     if len(matches) > 0:
         return matches
 
     # try removing trailing _001
-    v1 = re.sub(r'_00\d', '', v)
-    matches = list(filter(lambda m: match(m, v1), files))
+    v1 = trailing_number_re.sub('', v)
+    matches = matchIndex(index, v1)
     if len(matches) > 0:
         return matches
 
     # try replace first word with ''
-    v2 = re.sub(r'^[A-Za-z]+_', '', v)
-    matches = list(filter(lambda m: match(m, v2), files))
+    v2 = first_word_re.sub('', v)
+    matches = matchIndex(index, v2)
     if len(matches) > 0:
         return matches
     return []
@@ -123,12 +257,10 @@ def findJacketColor(v):
 
 
 def findPatternName(properties):
-    kl = list(filter(
-        lambda k: not 'Geo' in k and 'Plain' not in properties[k],
-        properties.keys()
-    ))
-    if len(kl) > 0:
-        return properties[kl[0]]
+    return next((
+        properties[k] for k in properties
+        if not 'Geo' in k and 'Plain' not in properties[k]
+    ), None)
 
 
 def findPatternTexture(v, patterns):
@@ -138,14 +270,14 @@ def findPatternTexture(v, patterns):
         return matches
 
     # try replacing first word with geo
-    v2 = re.sub(r'^Variant_', '', v)
+    v2 = variant_re.sub('', v)
     matches = list(filter(lambda m: match(m, v2), patterns))
     if len(matches) > 0:
         return matches
 
     # try removing last word
-    v3 = re.sub(r'^Variant_', '', v)
-    v3 = re.sub(r'_[a-zA-Z]+$', '', v3)
+    v3 = variant_re.sub('', v)
+    v3 = last_word_re.sub('', v3)
 
     matches = list(filter(lambda m: match(m, v3), patterns))
     if len(matches) > 0:
@@ -166,7 +298,8 @@ def findAndImport(
     exact=False
 ):
     """
-    :param v: name of the object to find
+    :param v: name of the object to find,
+        or list of names for exact matches sharing one material
     :param id: unique id for this avatar customization
     :param mainTexture: manually specify main texture
     :param mainColor: color to blend the main texure with
@@ -196,19 +329,24 @@ def findAndImport(
 
         logging.debug("Found %d model matches for %s: %s" %
                       (len(modelMatches), v, modelMatches if len(modelMatches) > 0 else []))
-        m = modelMatches[0]
+        ms = [modelMatches[0]]
     else:
-        m = "%s.fbx" % (v)
-    logging.debug("Selected model %s" % (m))
+        names = v if isinstance(v, list) else [v]
+        v = names[0]
+        ms = ["%s.fbx" % (n) for n in names]
 
     # import mesh
-    bpy.ops.import_scene.fbx(
-        filepath=os.path.abspath(
-            os.path.join('Models', m)
+    objects = []
+    for m in ms:
+        logging.debug("Selected model %s" % (m))
+        bpy.ops.import_scene.fbx(
+            filepath=os.path.abspath(
+                os.path.join('Models', m)
+            ),
+            use_anim=False
         )
-    )
-    name = m.strip('.fbx')
-    object = bpy.context.scene.objects[name]
+        name = m.strip('.fbx')
+        objects.append(bpy.context.scene.objects[name])
 
     # main texture
     if not mainTexture:
@@ -221,16 +359,14 @@ def findAndImport(
         logging.debug("Found %d texture matches for %s: %s" %
                       (len(textureMatches), v, textureMatches if len(textureMatches) > 0 else []))
         t = list(filter(lambda m: 'BaseColor' in m, textureMatches))
-        t = sorted(t, key=lambda k: len(k))[0]
+        t = min(t, key=len)
     else:
         textureMatches = [mainTexture]
         t = textureMatches[0]
     logging.debug("Selected main texture %s" % (t))
 
     tmp_path = getTmpPath(id)
-    if not os.path.exists(tmp_path):
-        os.makedirs(tmp_path)
-    mainTextureFilepath = os.path.abspath(os.path.join('Textures', t))
+    mainTextureFilepath = getTexturePath(t)
 
     # blend filename has the same as the main texture filename
     blendFilename = os.path.basename(mainTextureFilepath)
@@ -252,17 +388,20 @@ def findAndImport(
 
         if t2:
             logging.debug("Selected secondary texture %s" % (t2))
-            secondTextureFilepath = os.path.abspath(
-                os.path.join('Textures', t2)
-            )
-    blend(
-        v,
+            secondTextureFilepath = getTexturePath(t2)
+    blendArgs = dict(
         mainTextureFilepath=mainTextureFilepath,
         mainColor=mainColor,
         secondTextureFilepath=secondTextureFilepath,
         secondColor=secondColor,
         blendFilepath=blendFilepath
     )
+    if not blendExecutor:
+        blend(v, **blendArgs)
+    elif blendFilepath not in pendingBlends:
+        # the first blend of a file wins, same as the exists check in blend
+        pendingBlends[blendFilepath] = \
+            blendExecutor.submit(blend, v, **blendArgs)
 
     # create a new material and apply the blend texture
     material = bpy.data.materials.new(v)
@@ -270,7 +409,11 @@ def findAndImport(
     bsdf = material.node_tree.nodes["Principled BSDF"]
 
     texture = material.node_tree.nodes.new('ShaderNodeTexImage')
-    texture.image = bpy.data.images.load(blendFilepath)
+    if blendExecutor:
+        # loaded by finishBlends once the blend is saved
+        pendingTextures.append((texture, blendFilepath))
+    else:
+        texture.image = bpy.data.images.load(blendFilepath)
 
     material.node_tree.links.new(
         bsdf.inputs['Base Color'],
@@ -281,45 +424,56 @@ def findAndImport(
         inputs['Roughness'].\
         default_value = 1
 
-    object.data.materials.clear()
-    object.data.materials.append(material)
-
-    # shape keys
-    if object.data.shape_keys and shapeKeys:
-        logging.debug(
-            "Setting shape key %f, %f, %f" %
-            (shapeKeys[0], shapeKeys[1], shapeKeys[2])
-        )
-        # set value
-        i = 0
-        kbs = object.data.shape_keys.key_blocks
-        for kb in kbs:
-            if kb.name == 'Basis':
-                continue
-            if i >= len(shapeKeys):
-                break
-            kb.value = shapeKeys[i]
-            i += 1
-        # apply
-        # 1. create new key from mix
-        object.shape_key_add(name='Mix Key', from_mix=True)
-        ai = kbs.find('Mix Key')
-        object.active_shape_key_index = ai
-        # 2. in edit mode, vertex => propagate shape to all
-        bpy.context.view_layer.objects.active = object
-        bpy.ops.object.mode_set(mode='EDIT')
-        for v in object.data.vertices:
-            v.select = True
-        bpy.ops.mesh.shape_propagate_to_all()
-        # 3. in object mode clear shape key
-        bpy.ops.object.mode_set(mode='OBJECT')
-        object.shape_key_clear()
+    for object in objects:
+        object.data.materials.clear()
+        object.data.materials.append(material)
+        applyShapeKeys(object, shapeKeys)
 
     return True
 
 
+def applyShapeKeys(object, shapeKeys):
+    """
+    Set the shape key values and apply them to the mesh
+
+    :param object: imported object
+    :param shapeKeys: values for the shape keys after the basis
+    :return: None
+    """
+    if not object.data.shape_keys or not shapeKeys:
+        return
+
+    logging.debug(
+        "Setting shape key %f, %f, %f" %
+        (shapeKeys[0], shapeKeys[1], shapeKeys[2])
+    )
+    # set value
+    i = 0
+    kbs = object.data.shape_keys.key_blocks
+    for kb in kbs:
+        if kb.name == 'Basis':
+            continue
+        if i >= len(shapeKeys):
+            break
+        kb.value = shapeKeys[i]
+        i += 1
+    # apply, mix the keys into the mesh without going through edit mode
+    n = len(object.data.vertices)
+    basis = object.data.shape_keys.reference_key
+    coords = {kb.name: getCoords(kb.data, n) for kb in kbs}
+    mixed = coords[basis.name].copy()
+    for kb in kbs:
+        if kb == basis or kb.mute:
+            continue
+        mixed += \
+            (coords[kb.name] - coords[kb.relative_key.name]) * kb.value
+    object.shape_key_clear()
+    object.data.vertices.foreach_set('co', mixed)
+    object.data.update()
+
+
 def findEye(v):
-    matches = list(filter(lambda m: match(m, v), eyes))
+    matches = matchIndex(getIndex('Textures/eyes'), v)
     if len(matches) > 0:
         return matches
     return []
@@ -330,16 +484,10 @@ def setEyes(v, id):
     if len(eyeMatches) <= 0:
         return
 
-    tmp_path = getTmpPath(id)
-
     # right eye
     overlay(
-        mainTextureFilepath=os.path.abspath(
-            os.path.join(tmp_path, 'Avatar_Head_BaseColor.png')
-        ),
-        secondTextureFilepath=os.path.abspath(
-            os.path.join('Textures', 'eyes', eyeMatches[0])
-        ),
+        mainTextureFilepath=getHeadTexturePath(id),
+        secondTextureFilepath=getTexturePath('eyes', eyeMatches[0]),
         cutoff=0.001,
         uv=(0.05, 0.21),
         scale=1/4
@@ -347,12 +495,8 @@ def setEyes(v, id):
 
     # left eye
     overlay(
-        mainTextureFilepath=os.path.abspath(
-            os.path.join(tmp_path, 'Avatar_Head_BaseColor.png')
-        ),
-        secondTextureFilepath=os.path.abspath(
-            os.path.join('Textures', 'eyes', eyeMatches[0])
-        ),
+        mainTextureFilepath=getHeadTexturePath(id),
+        secondTextureFilepath=getTexturePath('eyes', eyeMatches[0]),
         cutoff=0.001,
         uv=(0.24, 0.21),
         scale=1/4,
@@ -361,7 +505,7 @@ def setEyes(v, id):
 
 
 def findMouth(v):
-    matches = list(filter(lambda m: match(m, v), mouths))
+    matches = matchIndex(getIndex('Textures/mouths'), v)
     if len(matches) > 0:
         return matches
     return []
@@ -374,18 +518,9 @@ def setMouth(v, id):
         return
 
     logging.debug("Found mouth %s", mouthMatches[0])
-    tmp_path = getTmpPath(id)
     overlay(
-        mainTextureFilepath=os.path.abspath(
-            os.path.abspath(
-                os.path.join(tmp_path, 'Avatar_Head_BaseColor.png')
-            )
-        ),
-        secondTextureFilepath=os.path.abspath(
-            os.path.abspath(
-                os.path.join('Textures', 'mouths', mouthMatches[0])
-            )
-        ),
+        mainTextureFilepath=getHeadTexturePath(id),
+        secondTextureFilepath=getTexturePath('mouths', mouthMatches[0]),
         cutoff=0.001,
         uv=(0.141, 0.06),
         scale=0.28
@@ -393,7 +528,7 @@ def setMouth(v, id):
 
 
 def findEyeBrow(v):
-    matches = list(filter(lambda m: match(m, v), textures))
+    matches = matchIndex(getIndex('Textures'), v)
     if len(matches) > 0:
         return matches
     return []
@@ -406,16 +541,11 @@ def setEyeBrows(v, id, mainColor=(1, 1, 1, 1)):
         return
 
     logging.debug("Found eye brow %s", eyeBrowMatches[0])
-    tmp_path = getTmpPath(id)
 
     # right eye brow
     overlay(
-        mainTextureFilepath=os.path.abspath(
-            os.path.join(tmp_path, 'Avatar_Head_BaseColor.png')
-        ),
-        secondTextureFilepath=os.path.abspath(
-            os.path.join('Textures', eyeBrowMatches[0])
-        ),
+        mainTextureFilepath=getHeadTexturePath(id),
+        secondTextureFilepath=getTexturePath(eyeBrowMatches[0]),
         cutoff=0.001,
         uv=(0.24, 0.265),
         scale=1/4,
@@ -425,12 +555,8 @@ def setEyeBrows(v, id, mainColor=(1, 1, 1, 1)):
 
     # left eye brow
     overlay(
-        mainTextureFilepath=os.path.abspath(
-            os.path.join(tmp_path, 'Avatar_Head_BaseColor.png')
-        ),
-        secondTextureFilepath=os.path.abspath(
-            os.path.join('Textures', eyeBrowMatches[0])
-        ),
+        mainTextureFilepath=getHeadTexturePath(id),
+        secondTextureFilepath=getTexturePath(eyeBrowMatches[0]),
         cutoff=0.001,
         uv=(0.05, 0.265),
         scale=1/4,
@@ -442,27 +568,18 @@ def setEyeBrows(v, id, mainColor=(1, 1, 1, 1)):
 
 def setHairBuzzed(id, secondColor=(1, 1, 1, 1)):
     logging.debug("Setting buzzed hair")
-    tmp_path = getTmpPath(id)
     blend(
         None,
-        mainTextureFilepath=os.path.abspath(
-            os.path.join(
-                tmp_path, 'Avatar_Head_BaseColor.png'
-            )
-        ),
+        mainTextureFilepath=getHeadTexturePath(id),
         mainColor=(1, 1, 1, 1),
-        secondTextureFilepath=os.path.abspath(
-            os.path.join(
-                'Textures', 'Hair_Shaved_001_BaseColor.png'
-            )
-        ),
+        secondTextureFilepath=getTexturePath('Hair_Shaved_001_BaseColor.png'),
         secondColor=secondColor,
         blendFilepath=None
     )
 
 
 def findStubble(v):
-    matches = list(filter(lambda m: match(m, v), textures))
+    matches = matchIndex(getIndex('Textures'), v)
     if len(matches) > 0:
         return matches
     return []
@@ -473,20 +590,11 @@ def setStubble(v, id, secondColor=(1, 1, 1, 1)):
     if len(stubbleMatches) <= 0:
         return
     logging.debug("Setting stubble %s" % (v))
-    tmp_path = getTmpPath(id)
     blend(
         None,
-        mainTextureFilepath=os.path.abspath(
-            os.path.join(
-                tmp_path, 'Avatar_Head_BaseColor.png'
-            )
-        ),
+        mainTextureFilepath=getHeadTexturePath(id),
         mainColor=(1, 1, 1, 1),
-        secondTextureFilepath=os.path.abspath(
-            os.path.join(
-                'Textures', stubbleMatches[0]
-            )
-        ),
+        secondTextureFilepath=getTexturePath(stubbleMatches[0]),
         secondColor=secondColor,
         blendFilepath=None
     )
@@ -496,11 +604,229 @@ def setStubble(v, id, secondColor=(1, 1, 1, 1)):
 ######################
 
 
+@lru_cache(maxsize=8)
 def getTmpPath(id):
     tmp_path = os.path.join(tmp_dir, id, 'textures')
+    os.makedirs(tmp_path, exist_ok=True)
     return tmp_path
 
 
+@lru_cache(maxsize=8)
+def getHeadTexturePath(id):
+    return os.path.abspath(
+        os.path.join(getTmpPath(id), 'Avatar_Head_BaseColor.png')
+    )
+
+
+@lru_cache(maxsize=None)
+def getTexturePath(*names):
+    return os.path.abspath(os.path.join('Textures', *names))
+
+
+def getPixels(image):
+    """
+    Read the pixels of an image in one call instead of
+    going through the python sequence api pixel by pixel.
+    Textures are 8 bit pngs, so pixels are kept as 8 bit
+    to cut the memory traffic of blend and overlay
+
+    :param image: blender image
+    :return: uint8 array of rgba pixels, shape (width * height, 4)
+    """
+    pixels = np.empty(len(image.pixels), dtype=np.float32)
+    image.pixels.foreach_get(pixels)
+    pixels *= 255
+    np.clip(pixels, 0, 255, out=pixels)
+    return np.rint(pixels).astype(np.uint8).reshape(-1, 4)
+
+
+def getCoords(data, n):
+    """
+    :param data: vertices or shape key data
+    :param n: number of vertices
+    :return: float32 array of vertex coordinates, shape (n * 3)
+    """
+    co = np.empty(n * 3, dtype=np.float32)
+    data.foreach_get('co', co)
+    return co
+
+
+def setPixels(image, pixels):
+    """
+    Write pixels back to an image as one contiguous buffer
+
+    :param image: blender image
+    :param pixels: uint8 array of rgba pixels
+    :return: None
+    """
+    image.pixels.foreach_set(pixels.ravel().astype(np.float32) / 255)
+    image.update()
+
+
+def colorToBytes(color):
+    """
+    :param color: rgba color, 0 to 1
+    :return: read only uint16 array of the color, 0 to 255
+    """
+    # palette colors are lists, the conversion is cached per color
+    return _colorToBytes(tuple(color))
+
+
+@lru_cache(maxsize=None)
+def _colorToBytes(color):
+    color = np.clip(np.asarray(color, dtype=np.float32), 0, 1)
+    color = np.rint(color * 255).astype(np.uint16)
+    color.setflags(write=False)
+    return color
+
+
+def multiplyColor(pixels, color):
+    """
+    :param pixels: uint8 array of rgba pixels
+    :param color: uint16 array from colorToBytes
+    :return: uint16 array of pixels * color, 0 to 255
+    """
+    return (pixels * color + 127) // 255
+
+
+def readImage(filepath):
+    """
+    :param filepath: path to the image file
+    :return: uint8 array of rgba pixels, shape (height, width, 4),
+        rows from bottom to top like blender images
+    """
+    if cv2:
+        pixels = cv2.imread(filepath, cv2.IMREAD_UNCHANGED)
+        if pixels is None:
+            # imread doesn't raise on missing or unreadable files
+            raise RuntimeError("Cannot read image %s" % (filepath))
+        if pixels.dtype == np.uint16:
+            pixels = np.rint(pixels / 257).astype(np.uint8)
+        if pixels.ndim == 2:
+            code = cv2.COLOR_GRAY2RGBA
+        elif pixels.shape[2] == 3:
+            code = cv2.COLOR_BGR2RGBA
+        else:
+            code = cv2.COLOR_BGRA2RGBA
+        return np.ascontiguousarray(cv2.cvtColor(pixels, code)[::-1])
+
+    image = bpy.data.images.load(filepath)
+    w, h = image.size
+    pixels = getPixels(image).reshape(h, w, 4)
+    bpy.data.images.remove(image)
+    return pixels
+
+
+def writeImage(filepath, pixels):
+    """
+    Save pixels as png, without alpha like a new blender image
+
+    :param filepath: path to the image file
+    :param pixels: uint8 array of rgba pixels, shape (height, width, 4)
+    :return: None
+    """
+    if cv2:
+        cv2.imwrite(
+            filepath,
+            cv2.cvtColor(
+                np.ascontiguousarray(pixels[::-1]), cv2.COLOR_RGBA2BGR
+            )
+        )
+        return
+
+    h, w = pixels.shape[:2]
+    image = bpy.data.images.new(
+        os.path.basename(filepath), width=w, height=h
+    )
+    setPixels(image, pixels)
+    image.filepath_raw = filepath
+    image.file_format = 'PNG'
+    image.save()
+    bpy.data.images.remove(image)
+
+
+def isRgbPng(filepath):
+    """
+    :param filepath: path to the image file
+    :return: whether the file is an 8 bit rgb png,
+        the format writeImage saves
+    """
+    with open(filepath, 'rb') as f:
+        header = f.read(26)
+    # signature, then the IHDR chunk with bit depth and color type
+    return len(header) == 26 \
+        and header[:8] == b'\x89PNG\r\n\x1a\n' \
+        and header[12:16] == b'IHDR' \
+        and header[24] == 8 and header[25] == 2
+
+
+def loadImage(filepath):
+    """
+    Load the pixels of an image once per file,
+    the pixels are shared between calls so any in place
+    modification must be marked in dirtyImages to be saved
+
+    :param filepath: path to the image file
+    :return: uint8 array of rgba pixels, shape (height, width, 4)
+    """
+    pixels = loadedImages.get(filepath)
+    if pixels is None:
+        pixels = loadedImages[filepath] = readImage(filepath)
+    return pixels
+
+
+def releaseImages():
+    """
+    Drop the loaded pixels of the images without unsaved changes
+    """
+    for filepath in list(loadedImages):
+        if filepath not in dirtyImages:
+            del loadedImages[filepath]
+
+
+def finishBlends():
+    """
+    Wait for the blends running in threads,
+    then load the blend textures into their materials
+    and drop the pixels that are saved
+    """
+    for future in pendingBlends.values():
+        future.result()
+    pendingBlends.clear()
+
+    for texture, blendFilepath in pendingTextures:
+        texture.image = bpy.data.images.load(blendFilepath)
+    pendingTextures.clear()
+    releaseImages()
+
+
+@contextmanager
+def blendThreads():
+    """
+    Run the blends of the imports in threads, without blender images
+    numpy and opencv release the gil. The blends are finished before
+    leaving, so errors in the threads are raised there
+    """
+    global blendExecutor
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        blendExecutor = executor if cv2 else None
+        try:
+            yield
+            finishBlends()
+        finally:
+            blendExecutor = None
+
+
+def saveImages():
+    """
+    Write the images modified in place back to their files
+    """
+    for filepath in dirtyImages:
+        writeImage(filepath, loadImage(filepath))
+    dirtyImages.clear()
+    releaseImages()
+
+
 def blend(
     v,
     mainTextureFilepath, mainColor,
@@ -521,59 +847,45 @@ def blend(
     :param blendFilepath: the actual file path to the blend texture on harddrive
     :return: None
     """
-    mainTexture = bpy.data.images.load(mainTextureFilepath)
-    mainTexturePixels = list(mainTexture.pixels[:])
-    for i in range(0, len(mainTexturePixels), 4):
-        mainTexturePixels[i] *= mainColor[0]
-        mainTexturePixels[i+1] *= mainColor[1]
-        mainTexturePixels[i+2] *= mainColor[2]
-        mainTexturePixels[i+3] *= mainColor[3]
+    if not (secondColor and secondTextureFilepath) \
+            and tuple(mainColor) == (1, 1, 1, 1) \
+            and mainTextureFilepath not in dirtyImages:
+        # nothing to blend, use the main texture file as is
+        # when it is already what writeImage would save
+        if v and blendFilepath and not os.path.exists(blendFilepath):
+            if isRgbPng(mainTextureFilepath):
+                shutil.copyfile(mainTextureFilepath, blendFilepath)
+            else:
+                writeImage(blendFilepath, readImage(mainTextureFilepath))
+        return
+
+    mainTexturePixels = loadImage(mainTextureFilepath)
+    # cached pixels are shared, don't modify them in place
+    blendPixels = multiplyColor(mainTexturePixels, colorToBytes(mainColor))
 
     if secondColor and secondTextureFilepath:
-        secondTexture = bpy.data.images.load(secondTextureFilepath)
-        secondTexturePixels = list(secondTexture.pixels[:])
-        for i in range(0, len(secondTexturePixels), 4):
-            alpha = secondTexturePixels[i+3]
-            mainTexturePixels[i] = \
-                mainTexturePixels[i] * (1-alpha) + \
-                secondTexturePixels[i] * secondColor[0] * alpha
-            mainTexturePixels[i+1] = \
-                mainTexturePixels[i+1] * (1-alpha) + \
-                secondTexturePixels[i+1] * secondColor[1] * alpha
-            mainTexturePixels[i+2] = \
-                mainTexturePixels[i+2] * (1-alpha) + \
-                secondTexturePixels[i+2] * secondColor[2] * alpha
-            mainTexturePixels[i+3] = \
-                mainTexturePixels[i+3] * (1-alpha) + \
-                secondTexturePixels[i+3] * secondColor[3] * alpha
-
-    # if target file not specified, save in main texture file
+        secondTexturePixels = loadImage(secondTextureFilepath)
+        alpha = secondTexturePixels[..., 3:4]
+        # (main * (255-alpha) + second * alpha) / 255,
+        # fits in uint16 and runs in place on one scratch buffer
+        scratch = multiplyColor(
+            secondTexturePixels, colorToBytes(secondColor)
+        )
+        scratch *= alpha
+        blendPixels *= 255 - alpha
+        blendPixels += scratch
+        blendPixels += 127
+        blendPixels //= 255
+    blendPixels = blendPixels.astype(np.uint8)
+
+    # if target file not specified, modify main texture in place
     if not v or not blendFilepath:
-        mainTexture.pixels[:] = mainTexturePixels
-        mainTexture.save()
+        mainTexturePixels[:] = blendPixels
+        dirtyImages.add(mainTextureFilepath)
         return
 
     if blendFilepath and not os.path.exists(blendFilepath):
-        blend = bpy.data.images.new(
-            v,
-            width=mainTexture.size[0],
-            height=mainTexture.size[1]
-        )
-        blend.pixels[:] = mainTexturePixels
-        blend.filepath_raw = blendFilepath
-        blend.file_format = 'PNG'
-        blend.save()
-
-
-def d2(a, b):
-    """
-    :param a: vector3
-    :param b: vector3
-    :return: distance between a and b squared
-    """
-    return (a[0]-b[0])*(a[0]-b[0]) \
-        + (a[1]-b[1])*(a[1]-b[1]) \
-        + (a[2]-b[2])*(a[2]-b[2])
+        writeImage(blendFilepath, blendPixels)
 
 
 class CutoffMode(Enum):
@@ -603,39 +915,46 @@ def overlay(
         if alpha then cutoff when alpha is less than cutoff value
     :return: None
     """
-    mainTexture = bpy.data.images.load(mainTextureFilepath)
-    mainTexturePixels = list(mainTexture.pixels[:])
-    w1 = mainTexture.size[0]
-    h1 = mainTexture.size[1]
-
-    secondTexture = bpy.data.images.load(secondTextureFilepath)
-    secondTexturePixels = list(secondTexture.pixels[:])
-    secondTextureFirstPixel = secondTexturePixels[:4]
-    w2 = secondTexture.size[0]
-
-    for i in range(0, len(secondTexturePixels), 4):
-        pixel = secondTexturePixels[i:i+4]
-        if mode == CutoffMode.COMPARE:
-            if d2(pixel[:3], secondTextureFirstPixel) < cutoff:
-                continue
-        elif mode == CutoffMode.ALPHA:
-            if pixel[3] < cutoff:
-                continue
-
-        x2 = i // 4 % w2
-        y2 = i // 4 // w2
-
-        x1 = round(uv[0]*w1 + x2 *
-                   scale) if not flipX else round(uv[0]*w1 + (w2-x2) * scale)
-        y1 = round(uv[1]*h1 + y2 * scale)
-        j = (x1 + y1 * w1) * 4
-        mainTexturePixels[j] = pixel[0] * mainColor[0]
-        mainTexturePixels[j+1] = pixel[1] * mainColor[1]
-        mainTexturePixels[j+2] = pixel[2] * mainColor[2]
-        mainTexturePixels[j+3] = pixel[3] * mainColor[3]
-
-    mainTexture.pixels[:] = mainTexturePixels
-    mainTexture.save()
+    # cached pixels, modified in place
+    mainTexturePixels = loadImage(mainTextureFilepath)
+    h1, w1 = mainTexturePixels.shape[:2]
+
+    secondTexturePixels = loadImage(secondTextureFilepath)
+    h2, w2 = secondTexturePixels.shape[:2]
+
+    if mode == CutoffMode.COMPARE:
+        # squared distance to the first pixel
+        d = secondTexturePixels[..., :3].astype(np.int32) - \
+            secondTexturePixels[0, 0, :3]
+        mask = np.sum(d*d, axis=-1) >= cutoff * 255 * 255
+    elif mode == CutoffMode.ALPHA:
+        mask = secondTexturePixels[..., 3] >= cutoff * 255
+    else:
+        mask = np.ones((h2, w2), dtype=bool)
+
+    x2, y2 = np.meshgrid(np.arange(w2), np.arange(h2))
+    x1 = np.round(
+        uv[0]*w1 + ((w2-x2) if flipX else x2) * scale
+    ).astype(np.int32)
+    y1 = np.round(uv[1]*h1 + y2 * scale).astype(np.int32)
+    # flat pixel index like the pixel list used to be indexed,
+    # past the right edge runs into the next row and
+    # negative indices wrap from the end
+    n = h1 * w1
+    j = (x1 + y1 * w1)[mask]
+    j[j < 0] += n
+    # still out of range after one wrap, the pixel list raised too
+    if j.size and (j.min() < 0 or j.max() >= n):
+        raise IndexError("overlay pixel out of range")
+    # fancy index assignment doesn't say which duplicate wins,
+    # keep only the last one like the loop did
+    _, last = np.unique(j[::-1], return_index=True)
+    last = len(j) - 1 - last
+    mainTexturePixels.reshape(-1, 4)[j[last]] = multiplyColor(
+        secondTexturePixels[mask][last], colorToBytes(mainColor)
+    )
+
+    dirtyImages.add(mainTextureFilepath)
     return
 
 
@@ -661,6 +980,35 @@ def add_point_light(
     return light_object
 
 
+@contextmanager
+def deferredUpdates():
+    """
+    Detach the depsgraph update handlers while importing
+    a batch of meshes and update the view layer once at the end
+    """
+    handlers = list(bpy.app.handlers.depsgraph_update_post)
+    bpy.app.handlers.depsgraph_update_post.clear()
+    try:
+        yield
+    finally:
+        bpy.app.handlers.depsgraph_update_post.extend(handlers)
+        bpy.context.view_layer.update()
+
+
+@contextmanager
+def workingDir(dir):
+    """
+    Change the working directory and restore it even on errors,
+    like contextlib.chdir which needs python 3.11
+    """
+    cwd = os.getcwd()
+    os.chdir(dir)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+
 def clearData():
     bpy.data.batch_remove(bpy.data.objects)
     bpy.data.batch_remove(bpy.data.meshes)
@@ -668,6 +1016,8 @@ def clearData():
     bpy.data.batch_remove(bpy.data.textures)
     bpy.data.batch_remove(bpy.data.images)
     bpy.data.batch_remove(bpy.data.armatures)
+    loadedImages.clear()
+    dirtyImages.clear()
 
 
 def clearDir(dir):
@@ -753,13 +1103,22 @@ if __name__ == "__main__":
 
     fh = sys.stdin if input == '-' else open(input)
     customizations = json.load(fh)
-    id = sha256(json.dumps(customizations).encode('utf-8')).hexdigest()
+    # canonical json, so equivalent customizations share the same tmp dir
+    # (hashlib uses openssl, which has sha-ni support since 1.1.1)
+    raw = json.dumps(
+        customizations, sort_keys=True, separators=(',', ':')
+    ).encode('utf-8')
+    id = sha256(raw).hexdigest()
     colors = customizations['color_palette']
+    hairColor = colors['Hair Color']
+    topColor = colors['Generic Top Color']
     s = customizations['selections']
 
     # remove defaults (keep camera in case of preview)
     bpy.data.objects.remove(bpy.data.objects["Cube"])
     bpy.data.objects.remove(bpy.data.objects["Light"])
+    if not preview:
+        bpy.data.objects.remove(bpy.data.objects["Camera"])
 
     blendSets = customizations['blend_sets']
     faceShape = blendSets['FaceShape']
@@ -803,264 +1162,255 @@ if __name__ == "__main__":
         bodyShape = [1, 1, 1]
         neckArea = [1, 1, 1]
 
-    # head
-    findAndImport(
-        'Avatar_Head', id,
-        mainColor=colors.get('SkinColor', (1, 1, 1, 1)),
-        shapeKeys=faceShape
-    )
-
-    hat = s.get('Hat', {}).get('value', 'No_Hat').replace(' ', '_')
-
-    # hat special cases
-    if ('BaseballCap_Snapback' in hat and s['Hat']['properties']['GeoVariants_BaseballCap_002'] == 'GeoVariant_Backwards'):
-        hat = hat.replace('Snapback', 'Snapback_Backwards')
-    if 'Robot_Beanie' in hat:
-        hat = 'Hat_Robot_001'
-    elif 'Robot_BaseballCap' in hat:
-        hat = 'Hat_Robot_002'
-
-    hat_t = None
-    if 'Snapback_Backwards' in hat:
-        hat_t = 'BaseballCap_Snapback_002_Mat_BaseColor.png'
-
-    hair = s.get('Hair', {}).get('value', 'No_Hair').replace(' ', '_')
-    hairPattern = findPatternName(s.get('Hair', {}).get('properties', {}))
-    # hair special cases
-    hair = hair.replace('Curly_Loose_Long', 'Curl_Loose_long')
-    hair_t = None
-    if hair == 'MidFade_LowVolume_001':
-        hair_t = 'MidFade_HighVolume_001_BaseColor.png'
-    hair_t2 = None
-    if 'SidePart_Short' in hair:
-        hair_t2 = 'SidePart_Mid_Wavy_001_PatternColor1.png'
-    
-    # hair pattern special cases
-    if 'Variant_Bob_002' in hair:
-        hair_t2 = 'Bob_001_mat_gradient_PatternColor1.png'
-
-    # hair mesh is cutoff when wearing hats
-    if isSelected(hat):
-        hatPattern = findPatternName(s.get('Hat', {}).get('properties', {}))
-        # hat pattern special cases
-        if ('Hat_Robot' in hat):
-            hatPattern = 'Robot_001_Plain_PatternColor2'
+    # imports share one depsgraph update,
+    # head texture must be saved before adding eyes and mouth
+    with blendThreads(), deferredUpdates():
+        # head
         findAndImport(
-            hat, id,
-            p=hatPattern,
-            mainTexture=hat_t,
-            mainColor=colors['Generic Hat Color'],
-            secondColor=colors['Generic Hat Secondary Color'],
+            'Avatar_Head', id,
+            mainColor=colors.get('SkinColor', (1, 1, 1, 1)),
             shapeKeys=faceShape
         )
-        if isSelected(hair):
+
+        hat = s.get('Hat', {}).get('value', 'No_Hat').translate(space_to_underscore)
+
+        # hat special cases
+        if ('BaseballCap_Snapback' in hat and s['Hat']['properties']['GeoVariants_BaseballCap_002'] == 'GeoVariant_Backwards'):
+            hat = hat.replace('Snapback', 'Snapback_Backwards')
+        if 'Robot_Beanie' in hat:
+            hat = 'Hat_Robot_001'
+        elif 'Robot_BaseballCap' in hat:
+            hat = 'Hat_Robot_002'
+
+        hat_t = None
+        if 'Snapback_Backwards' in hat:
+            hat_t = 'BaseballCap_Snapback_002_Mat_BaseColor.png'
+
+        hair = s.get('Hair', {}).get('value', 'No_Hair').translate(space_to_underscore)
+        hairPattern = findPatternName(s.get('Hair', {}).get('properties', {}))
+        # hair special cases
+        hair = hair.replace('Curly_Loose_Long', 'Curl_Loose_long')
+        hair_t = None
+        if hair == 'MidFade_LowVolume_001':
+            hair_t = 'MidFade_HighVolume_001_BaseColor.png'
+        hair_t2 = None
+        if 'SidePart_Short' in hair:
+            hair_t2 = 'SidePart_Mid_Wavy_001_PatternColor1.png'
+
+        # hair pattern special cases
+        if 'Variant_Bob_002' in hair:
+            hair_t2 = 'Bob_001_mat_gradient_PatternColor1.png'
+
+        # hair mesh is cutoff when wearing hats
+        if isSelected(hat):
+            hatPattern = findPatternName(s.get('Hat', {}).get('properties', {}))
+            # hat pattern special cases
+            if ('Hat_Robot' in hat):
+                hatPattern = 'Robot_001_Plain_PatternColor2'
             findAndImport(
-                hair+"_HatHair", id,
-                p=hairPattern,
-                mainTexture=hair_t,
-                mainColor=colors['Hair Color'],
-                secondTexture=hair_t2,
-                secondColor=colors['Hair Dye Color'],
+                hat, id,
+                p=hatPattern,
+                mainTexture=hat_t,
+                mainColor=colors['Generic Hat Color'],
+                secondColor=colors['Generic Hat Secondary Color'],
                 shapeKeys=faceShape
             )
-    else:
-        if isSelected(hair):
+            if isSelected(hair):
+                findAndImport(
+                    hair+"_HatHair", id,
+                    p=hairPattern,
+                    mainTexture=hair_t,
+                    mainColor=hairColor,
+                    secondTexture=hair_t2,
+                    secondColor=colors['Hair Dye Color'],
+                    shapeKeys=faceShape
+                )
+        else:
+            if isSelected(hair):
+                findAndImport(
+                    hair, id,
+                    p=hairPattern,
+                    mainTexture=hair_t,
+                    mainColor=hairColor,
+                    secondTexture=hair_t2,
+                    secondColor=colors['Hair Dye Color'],
+                    shapeKeys=faceShape
+                )
+
+        facialHair = s['Facial Hair']['value'].translate(space_to_underscore)
+        if isSelected(facialHair):
             findAndImport(
-                hair, id,
-                p=hairPattern,
-                mainTexture=hair_t,
-                mainColor=colors['Hair Color'],
-                secondTexture=hair_t2,
-                secondColor=colors['Hair Dye Color'],
+                facialHair, id,
+                mainColor=hairColor,
                 shapeKeys=faceShape
             )
 
-    facialHair = s['Facial Hair']['value'].replace(' ', '_')
-    if isSelected(facialHair):
-        findAndImport(
-            facialHair, id,
-            mainColor=colors['Hair Color'],
-            shapeKeys=faceShape
-        )
+        eyewear = s['Eyewear']['value'].translate(space_to_underscore)
+        if isSelected(eyewear):
+            findAndImport(eyewear, id, mainColor=colors['Generic Glasses Color'])
 
-    eyewear = s['Eyewear']['value'].replace(' ', '_')
-    if isSelected(eyewear):
-        findAndImport(eyewear, id, mainColor=colors['Generic Glasses Color'])
+        noses = s['Noses']['value'].translate(space_to_underscore)
+        # nose special cases
+        if noses == 'Nose_Upturned_001':
+            noses = 'Nose_Straight_001'
 
-    noses = s['Noses']['value'].replace(' ', '_')
-    # nose special cases
-    if noses == 'Nose_Upturned_001':
-        noses = 'Nose_Straight_001'
+        findAndImport(noses, id, mainColor=colors['SkinColor'])
 
-    findAndImport(noses, id, mainColor=colors['SkinColor'])
+        # body
+        findAndImport(
+            'Avatar_Body', id,
+            mainColor=colors['SkinColor'],
+            shapeKeys=bodyShape
+        )
 
-    # body
-    findAndImport(
-        'Avatar_Body', id,
-        mainColor=colors['SkinColor'],
-        shapeKeys=bodyShape
-    )
+        # top special cases
+        top = s['Top']['value'].translate(space_to_underscore)
+        top = top.replace('Top_Crew_Neck_T-Shirt', 'VNeck_Shirt')
+        top = top.replace('V-Neck_Shirt', 'VNeck_Shirt')
+        if 'Tshirt_Robot_00' in top:
+            top = 'Hoodie_Robot_002'
+        top_t1 = None
+        if top == 'ButtonUp_Shirt_001':
+            top_t1 = 'Shirt_Buttonup_001_BaseColor.png'
+        elif top == 'ButtonUp_Shirt_002':
+            top_t1 = 'Shirt_Buttonup_002_mat_BaseColor.png'
+        topPattern = findPatternName(s.get('Top', {}).get('properties', {}))
+        top_t2 = None
+        top_c2 = colors['Generic Top Secondary Color'];
+        if topPattern == 'Blouse_Tied_001_PolkaDot':
+            top_t2 = 'Blouse_Tied_001_Mat_PatternColor1.png'
+        elif topPattern == 'Variant_Dress_Wrap_001_Floral':
+            top_t2 = 'Dress_Wrap_001_mat_Flower_PatternColor1.png'
+        elif topPattern == 'Variant_ButtonUp_Vest_001_Dark':
+            top_t2 = 'ButtonUp_Vest_001_Dark_PatternColor2.png'
+            top_c2 = (0.1, 0.1, 0.1, 1)
+        elif topPattern == 'Variant_ButtonUp_Shirt_002_Dots':
+            top_t2 = 'Shirt_Buttonup_002_mat_Dots_PatternColor1.png'
 
-    # top special cases
-    top = s['Top']['value'].replace(' ', '_')
-    top = top.replace('Top_Crew_Neck_T-Shirt', 'VNeck_Shirt')
-    top = top.replace('V-Neck_Shirt', 'VNeck_Shirt')
-    if 'Tshirt_Robot_00' in top:
-        top = 'Hoodie_Robot_002'
-    top_t1 = None
-    if top == 'ButtonUp_Shirt_001':
-        top_t1 = 'Shirt_Buttonup_001_BaseColor.png'
-    elif top == 'ButtonUp_Shirt_002':
-        top_t1 = 'Shirt_Buttonup_002_mat_BaseColor.png'
-    topPattern = findPatternName(s.get('Top', {}).get('properties', {}))
-    top_t2 = None
-    top_c2 = colors['Generic Top Secondary Color'];
-    if topPattern == 'Blouse_Tied_001_PolkaDot':
-        top_t2 = 'Blouse_Tied_001_Mat_PatternColor1.png'
-    elif topPattern == 'Variant_Dress_Wrap_001_Floral':
-        top_t2 = 'Dress_Wrap_001_mat_Flower_PatternColor1.png'
-    elif topPattern == 'Variant_ButtonUp_Vest_001_Dark':
-        top_t2 = 'ButtonUp_Vest_001_Dark_PatternColor2.png'
-        top_c2 = (0.1, 0.1, 0.1, 1)
-    elif topPattern == 'Variant_ButtonUp_Shirt_002_Dots':
-        top_t2 = 'Shirt_Buttonup_002_mat_Dots_PatternColor1.png'
-
-
-    findAndImport(
-        top, id,
-        p=topPattern,
-        mainTexture=top_t1,
-        mainColor=colors['Generic Top Color'],
-        secondTexture=top_t2,
-        secondColor=top_c2,
-        excludes=['Cuff', 'Cuffs'],
-        shapeKeys=bodyShape
-    )
 
-    jacket = s.get('Jacket', {}).get('value', 'No_Jacket').replace(' ', '_')
-    jacketExact = False
-    # jacket special cases
-    if jacket == 'Biker_Jacket':
-        jacket = 'Jacket'
-        jacketExact = True
-    # jacket pattern special cases
-    jacketPattern = findPatternName(s.get('Jacket', {}).get('properties', {}))
-    if (jacketPattern == 'Variant_TwoTone'):
-        jacketPattern = 'Blazer_Tuxedo_001_PatternColor1'
-    jacketColor = findJacketColor(jacket)
-    logging.debug("Set Jacket Color %s", jacketColor)
-
-    if isSelected(jacket):
         findAndImport(
-            jacket, id,
-            p=jacketPattern,
+            top, id,
+            p=topPattern,
+            mainTexture=top_t1,
+            mainColor=topColor,
+            secondTexture=top_t2,
+            secondColor=top_c2,
             excludes=['Cuff', 'Cuffs'],
-            mainColor=colors[jacketColor],
-            secondColor=colors['Generic Jacket Secondary Color'],
-            shapeKeys=bodyShape,
-            exact=jacketExact
-        )
-
-    bottom = s.get('Bottom', {}).get('value', 'No_Bottom')
-    if isSelected(bottom):
-        findAndImport(
-            bottom, id,
-            mainColor=colors['Generic Bottoms Color'],
-            # shapeKeys=(bodyShape[2], 0, 0),
-            # shapeKeys=(bodyShape[2],0,0) if bodyShape[2] == 1 else bodyShape
             shapeKeys=bodyShape
         )
 
-    # hands
-    nailPattern = findPatternName(s.get('Fingernails', {}).get('properties', {}))
-    findAndImport('Avatar_Hand_L', id, mainColor=colors['SkinColor'])
-    findAndImport('Avatar_Hand_R', id, mainColor=colors['SkinColor'])
-    findAndImport(
-        'Avatar_Nails_L', id,
-        mainTexture='Fingernails_BaseColor.png',
-        mainColor=colors['NailColor'] if nailPattern else colors['SkinColor']
-    )
-    findAndImport(
-        'Avatar_Nails_R', id,
-        mainTexture='Fingernails_BaseColor.png',
-        mainColor=colors['NailColor'] if nailPattern else colors['SkinColor']
-    )
+        jacket = s.get('Jacket', {}).get('value', 'No_Jacket').translate(space_to_underscore)
+        jacketExact = False
+        # jacket special cases
+        if jacket == 'Biker_Jacket':
+            jacket = 'Jacket'
+            jacketExact = True
+        # jacket pattern special cases
+        jacketPattern = findPatternName(s.get('Jacket', {}).get('properties', {}))
+        if (jacketPattern == 'Variant_TwoTone'):
+            jacketPattern = 'Blazer_Tuxedo_001_PatternColor1'
+        jacketColor = findJacketColor(jacket)
+        logging.debug("Set Jacket Color %s", jacketColor)
+
+        if isSelected(jacket):
+            findAndImport(
+                jacket, id,
+                p=jacketPattern,
+                excludes=['Cuff', 'Cuffs'],
+                mainColor=colors[jacketColor],
+                secondColor=colors['Generic Jacket Secondary Color'],
+                shapeKeys=bodyShape,
+                exact=jacketExact
+            )
 
-    # cuffs
-    logging.debug("Getting Cuffs")
-    foundJacketCuffs = True
-    cuff = jacket
-    cuff_t = None
-    # cuffs special cases
-    if jacket == 'Jacket':
-        cuff = 'Jacket_Cuffs'
-        cuff_t = 'Jacket_Biker_001_BaseColor.png'
-    if top == 'Hoodie_Robot_002':
-        cuff = top
-        cuff_t = 'Hoodie_Robot_002_Plain_BaseColor.png'
-    if isSelected(jacket):
-        lf = findAndImport(
-            cuff, id,
-            mainTexture=cuff_t,
-            mainColor=colors[jacketColor],
-            includes=['Cuffs_L', 'Cuff_L']
-        )
-        rf = findAndImport(
-            cuff, id,
-            mainTexture=cuff_t,
-            mainColor=colors[jacketColor],
-            includes=['Cuffs_R', 'Cuff_R']
-        )
-        foundJacketCuffs = lf & rf
-    if not isSelected(jacket) or not foundJacketCuffs:
-        mainTexture = list(filter(
-            lambda t: 'BaseColor' in t,
-            findTexture(top))
-        )
-        mainTexture = mainTexture[0] \
-            if len(mainTexture) > 0 \
-            else 'Tshirt_CrewNeck_001_BaseColor.png'
+        bottom = s.get('Bottom', {}).get('value', 'No_Bottom')
+        if isSelected(bottom):
+            findAndImport(
+                bottom, id,
+                mainColor=colors['Generic Bottoms Color'],
+                # shapeKeys=(bodyShape[2], 0, 0),
+                # shapeKeys=(bodyShape[2],0,0) if bodyShape[2] == 1 else bodyShape
+                shapeKeys=bodyShape
+            )
+
+        # hands
+        nailPattern = findPatternName(s.get('Fingernails', {}).get('properties', {}))
+        findAndImport('Avatar_Hand_L', id, mainColor=colors['SkinColor'])
+        findAndImport('Avatar_Hand_R', id, mainColor=colors['SkinColor'])
         findAndImport(
-            'Cuff_L', id, exact=True,
-            mainTexture=mainTexture,
-            mainColor=colors['Generic Top Color']
+            'Avatar_Nails_L', id,
+            mainTexture='Fingernails_BaseColor.png',
+            mainColor=colors['NailColor'] if nailPattern else colors['SkinColor']
         )
         findAndImport(
-            'Cuff_R', id, exact=True,
-            mainTexture=mainTexture,
-            mainColor=colors['Generic Top Color']
+            'Avatar_Nails_R', id,
+            mainTexture='Fingernails_BaseColor.png',
+            mainColor=colors['NailColor'] if nailPattern else colors['SkinColor']
         )
 
+        # cuffs
+        logging.debug("Getting Cuffs")
+        foundJacketCuffs = True
+        cuff = jacket
+        cuff_t = None
+        # cuffs special cases
+        if jacket == 'Jacket':
+            cuff = 'Jacket_Cuffs'
+            cuff_t = 'Jacket_Biker_001_BaseColor.png'
+        if top == 'Hoodie_Robot_002':
+            cuff = top
+            cuff_t = 'Hoodie_Robot_002_Plain_BaseColor.png'
+        if isSelected(jacket):
+            lf = findAndImport(
+                cuff, id,
+                mainTexture=cuff_t,
+                mainColor=colors[jacketColor],
+                includes=['Cuffs_L', 'Cuff_L']
+            )
+            rf = findAndImport(
+                cuff, id,
+                mainTexture=cuff_t,
+                mainColor=colors[jacketColor],
+                includes=['Cuffs_R', 'Cuff_R']
+            )
+            foundJacketCuffs = lf & rf
+        if not isSelected(jacket) or not foundJacketCuffs:
+            mainTexture = next(
+                (t for t in findTexture(top) if 'BaseColor' in t),
+                'Tshirt_CrewNeck_001_BaseColor.png'
+            )
+            findAndImport(
+                ['Cuff_L', 'Cuff_R'], id, exact=True,
+                mainTexture=mainTexture,
+                mainColor=topColor
+            )
+
     # eyes and mouth
-    eye = s['Eyes']['value'].replace('Eyes ', '')
+    eye = s['Eyes']['value'].removeprefix('Eyes ')
     setEyes(eye, id)
-    mouth = s['Mouth']['value'].replace(' ', '_')
+    mouth = s['Mouth']['value'].translate(space_to_underscore)
     setMouth(mouth, id)
 
     # eye brows
-    eyeBrows = s['Eyebrows']['value'].replace(' ', '_')
+    eyeBrows = s['Eyebrows']['value'].translate(space_to_underscore)
 
     # eye brows special cases
-    eyeBrows = eyeBrows.replace('_01', '_001')
-    eyeBrows = eyeBrows.replace('Angled_001', 'EyeBrow_Angled_001')
-    eyeBrows = eyeBrows.replace('Eyebrow_', '')
-    eyeBrows = eyeBrows.replace('Arched_Thick', 'ArchBushy')
-    eyeBrows = eyeBrows.replace('Arched_Medium', 'ArchHigh')
-    eyeBrows = eyeBrows.replace('ThickFlat_001', 'ThickFlat')
+    eyeBrows = eyebrow_re.sub(
+        lambda m: eyebrow_replacements[m.group(0)], eyeBrows
+    )
     setEyeBrows(
         eyeBrows, id,
-        mainColor=colors['Hair Color']
+        mainColor=hairColor
     )
 
     # hair buzzed
     if hair == 'Hair_Buzzed':
         setHairBuzzed(
             id,
-            secondColor=colors['Hair Color']
+            secondColor=hairColor
         )
 
     # face stubble
-    stubble = s['Skin']['properties']['FacialHairVariants']
     stubble = s.get('Skin', {})\
         .get('properties', {})\
         .get('FacialHairVariants', 'No_Stubble')
@@ -1068,19 +1418,20 @@ if __name__ == "__main__":
         stubble = stubble.replace('FacialhairVariant_', '')
         setStubble(
             stubble, id,
-            secondColor=colors['Hair Color']
+            secondColor=hairColor
         )
 
+    # write the decorated head texture once
+    saveImages()
+    # every lookup is done, keep the listings for the next run
+    saveManifest()
+
     if preview:
         # camera
         camera = bpy.data.objects["Camera"]
         camera.rotation_mode = 'XYZ'
-        camera.rotation_euler[0] = 90*(pi/180.0)
-        camera.rotation_euler[1] = 0
-        camera.rotation_euler[2] = 0
-        camera.location.x = -0.021513
-        camera.location.y = -2.7
-        camera.location.z = 1.36731
+        camera.rotation_euler = camera_rotation
+        camera.location = camera_location
 
         # lighting
         lightA = add_point_light(
@@ -1109,12 +1460,8 @@ if __name__ == "__main__":
         name = 'Preview_Background'
         background = bpy.context.scene.objects[name]
 
-        preview_dir = os.path.dirname(output)
-        fn = os.path.basename(output)
-        fn = re.sub(r'\.fbx$', '', fn)
-        fn = re.sub(r'$', '.png', fn)
-        preview_filepath = os.path.join(preview_dir, fn)
-        filepath = os.path.abspath(preview_filepath)
+        # same as the output, output is already an absolute path
+        filepath = os.path.splitext(output)[0] + '.png'
         bpy.context.scene.render.filepath = filepath
         bpy.context.scene.render.image_settings.file_format = 'PNG'
         bpy.context.scene.render.resolution_x = 512
@@ -1124,10 +1471,12 @@ if __name__ == "__main__":
         bpy.data.objects.remove(background)
         bpy.data.objects.remove(lightA)
         bpy.data.objects.remove(lightB)
-
-    bpy.data.objects.remove(bpy.data.objects["Camera"])
+        bpy.data.objects.remove(camera)
 
     if rig:
+        # appended fresh for every build: each avatar runs in its own blender
+        # process, and the appended rig is modified in place by auto rig pro
+        # (match_to_rig, joins) so it can't be kept around as a template
         rig_filepath = os.path.realpath('rig.blend')
         with bpy.data.libraries.load(rig_filepath) as (data_from, data_to):
             data_to.objects = data_from.objects
@@ -1135,26 +1484,68 @@ if __name__ == "__main__":
             if obj is not None:
                 bpy.context.scene.collection.objects.link(obj)
 
+        # look up objects by name once
+        objs = bpy.data.objects
+        body = objs["Avatar_Body"]
+        head = objs["Avatar_Head"]
+        limbs = objs["Limbs"]
+        rig_obj = objs["rig"]
+        # live view of the collection, reflects the joins below
+        objects = bpy.data.collections['Collection'].all_objects
+
         logging.debug("Joining meshes ...")
-        # fix neck
-        body = bpy.data.objects["Avatar_Body"]
-        body.select_set(True)
-        head = bpy.data.objects["Avatar_Head"]
-        head.select_set(True)
-        bpy.context.view_layer.objects.active = head
-        bpy.ops.object.join()
-        bpy.ops.object.mode_set(mode='EDIT')
-        bpy.ops.mesh.remove_doubles(threshold=0.01)
-        bpy.ops.object.mode_set(mode='OBJECT')
+        # fix neck, concatenate the body into the head mesh
+        # with bmesh instead of the join operator
+        bm = bmesh.new()
+        bm.from_mesh(head.data)
+        headVerts = len(bm.verts)
+        headFaces = len(bm.faces)
+        bm.from_mesh(body.data)
+        bm.verts.ensure_lookup_table()
+        bm.faces.ensure_lookup_table()
+        # join works in world space, move the body into head space
+        bmesh.ops.transform(
+            bm,
+            matrix=head.matrix_world.inverted() @ body.matrix_world,
+            verts=bm.verts[headVerts:]
+        )
+        # body faces keep their materials, appended after the head ones
+        materialOffset = len(head.data.materials)
+        for material in body.data.materials:
+            head.data.materials.append(material)
+        for f in bm.faces[headFaces:]:
+            f.material_index += materialOffset
+        # body weights point at the body vertex groups,
+        # map them to the head groups by name like join does
+        groups = {
+            g.index: (
+                head.vertex_groups.get(g.name) or
+                head.vertex_groups.new(name=g.name)
+            ).index
+            for g in body.vertex_groups
+        }
+        if any(i != j for i, j in groups.items()):
+            deform = bm.verts.layers.deform.verify()
+            for v in bm.verts[headVerts:]:
+                weights = list(v[deform].items())
+                v[deform].clear()
+                for i, weight in weights:
+                    v[deform][groups[i]] = weight
+        # merge by distance, on every vertex so the neck seam is welded
+        bmesh.ops.remove_doubles(bm, verts=bm.verts, dist=0.01)
+        bm.to_mesh(head.data)
+        bm.free()
+        bpy.data.objects.remove(body)
         # join the meshes into one
-        objects = bpy.data.collections['Collection'].all_objects
+        bpy.ops.object.select_all(action='DESELECT')
         for obj in objects:
-            obj.select_set(True)
+            if obj.type == 'MESH':
+                obj.select_set(True)
 
-        limbs = bpy.data.objects["Limbs"]
         limbs_group = limbs.vertex_groups.new(name='Limbs')
+        # vertex indices are always 0 to n-1
         limbs_group.add(
-            list(map(lambda v: v.index, limbs.data.vertices)),
+            np.arange(len(limbs.data.vertices)).tolist(),
             0, 'ADD'
         )
 
@@ -1165,22 +1556,43 @@ if __name__ == "__main__":
         # auto rig using the autorig pro addon
         logging.debug("Auto rigging ...")
         # match to rig
-        rig = bpy.data.objects["rig"]
-        bpy.context.view_layer.objects.active = rig
+        bpy.context.view_layer.objects.active = rig_obj
         bpy.ops.arp.match_to_rig()
 
         # bind to rig
-        mesh = bpy.data.collections['Collection'].all_objects[0]
-        control_rig = bpy.data.objects["char_grp"]
+        mesh = objects[0]
         mesh.select_set(True)
         bpy.ops.arp.bind_to_rig()
 
-        # separate limbs
-        bpy.context.view_layer.objects.active = mesh
-        bpy.ops.object.vertex_group_set_active(group='Limbs')
-        bpy.ops.object.mode_set(mode='EDIT')
-        bpy.ops.object.vertex_group_select()
-        bpy.ops.mesh.separate(type='SELECTED')
+        # separate limbs, split a copy of the mesh with bmesh
+        # instead of selecting the vertex group in edit mode
+        limbsMesh = mesh.copy()
+        limbsMesh.data = mesh.data.copy()
+        bpy.data.collections['Collection'].objects.link(limbsMesh)
+        group = mesh.vertex_groups['Limbs'].index
+        for o, keep in ((mesh, False), (limbsMesh, True)):
+            bm = bmesh.new()
+            bm.from_mesh(o.data)
+            deform = bm.verts.layers.deform.active
+            inLimbs = {v for v in bm.verts if group in v[deform]}
+            if keep:
+                # drop everything outside the limbs
+                bmesh.ops.delete(
+                    bm, geom=[v for v in bm.verts if v not in inLimbs],
+                    context='VERTS'
+                )
+            else:
+                # drop the limb faces, with their now unused edges and verts
+                bmesh.ops.delete(
+                    bm, geom=[f for f in bm.faces if all(v in inLimbs for v in f.verts)],
+                    context='FACES'
+                )
+                bmesh.ops.delete(
+                    bm, geom=[v for v in inLimbs if v.is_valid and not v.link_edges],
+                    context='VERTS'
+                )
+            bm.to_mesh(o.data)
+            bm.free()
 
         # rename objects
         for o in objects:
@@ -1195,37 +1607,57 @@ if __name__ == "__main__":
 
     # export to fbx
     output_dir = os.path.dirname(output)
-    if output_dir and not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    # the plain export and the vrc re-export share their settings,
+    # no animation is baked: the parts are imported without it and
+    # vrc drives the humanoid rig with its own animations,
+    # the exported rig only needs its rest pose
+    exportFbx = partial(
+        bpy.ops.export_scene.fbx,
+        filepath=output,
+        embed_textures=True,
+        path_mode='COPY',
+        bake_anim=False
+    )
     if not rig:
-        bpy.ops.export_scene.fbx(
-            filepath=output,
-            embed_textures=True,
-            path_mode='COPY'
-        )
+        exportFbx()
     else:
         bpy.ops.arp.fix_rig_export()
         bpy.ops.id.arp_export_fbx_panel('EXEC_DEFAULT', filepath=output)
 
     if vrc:
+        # the export rig only exists inside the auto rig pro exporter,
+        # combine materials on the exported file and export it again
         clearData()
         bpy.ops.import_scene.fbx(filepath=output)
 
         # combine materials using the material-combiner-addon
-        cwd = os.getcwd()
         dir = os.path.abspath(os.path.join(tmp_dir, id))
-        os.chdir(dir)
-        bpy.ops.file.unpack_all(method='USE_LOCAL')
+        # the exported textures are embedded,
+        # unpack only the ones the combiner reads
+        images = {
+            node.image
+            for obj in bpy.context.scene.objects if obj.type == 'MESH'
+            for slot in obj.material_slots
+            if slot.material and slot.material.node_tree
+            for node in slot.material.node_tree.nodes
+            if node.type == 'TEX_IMAGE' and node.image
+        }
+        # the blend file is unsaved, so '//' resolves against the working
+        # directory, only the unpack needs it once the paths are absolute
+        with workingDir(dir):
+            for image in images:
+                if image.packed_file:
+                    image.unpack(method='USE_LOCAL')
+                    image.filepath = os.path.abspath(
+                        bpy.path.abspath(image.filepath)
+                    )
         bpy.ops.smc.refresh_ob_data()
         bpy.ops.smc.combiner(cats=False, directory=dir)
 
-        # overwrite
-        bpy.ops.export_scene.fbx(
-            filepath=output,
-            embed_textures=True,
-            path_mode='COPY'
-        )
-        os.chdir(cwd)
+        # overwrite, with the atlas embedded
+        exportFbx()
 
     # clean up temp files
     # clearTmp(id)
@@ -0,0 +1,169 @@
+import os
+import sys
+import json
+import logging
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+
+logging.basicConfig(level=logging.DEBUG)
+
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'avatar.py')
+
+
+def getId(input):
+    """
+    :param input: customization file
+    :return: id of the customizations, the same as avatar.py
+        so avatars sharing a tmp dir can be told apart
+    """
+    with open(input) as f:
+        customizations = json.load(f)
+    raw = json.dumps(
+        customizations, sort_keys=True, separators=(',', ':')
+    ).encode('utf-8')
+    return sha256(raw).hexdigest()
+
+
+def build(blender, input, output, flags):
+    """
+    :param blender: blender executable
+    :param input: customization file
+    :param output: fbx filepath
+    :param flags: options passed through to avatar.py
+    :return: blender's exit code
+    """
+    logging.debug("Building %s ..." % (input))
+    output_dir = os.path.dirname(output)
+    os.makedirs(output_dir, exist_ok=True)
+    log = os.path.splitext(output)[0] + '.log'
+    # every avatar gets its own blender process, and so its own bpy.data,
+    # blender exits with 0 on python errors unless told otherwise
+    with open(log, 'w') as f:
+        result = subprocess.run(
+            [
+                blender, '-b', '--python-exit-code', '1',
+                '--python', script, '--', '-i', input, '-o', output
+            ] + flags,
+            stdout=f,
+            stderr=subprocess.STDOUT
+        )
+    if result.returncode != 0:
+        logging.error("Failed to build %s, see %s" % (input, log))
+    return result.returncode
+
+
+def buildAll(blender, jobs, flags):
+    """
+    Build avatars sharing the same customizations one after the other,
+    they use the same tmp dir
+
+    :param blender: blender executable
+    :param jobs: list of (input, output) tuples
+    :param flags: options passed through to avatar.py
+    :return: list of blender's exit codes
+    """
+    return [build(blender, input, output, flags) for input, output in jobs]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'inputs',
+        nargs='+',
+        type=str,
+        help='input filepaths'
+    )
+    parser.add_argument(
+        '-o', '--output',
+        default='Exports',
+        type=str,
+        help='output directory (default: Exports)'
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        default=os.cpu_count(),
+        type=int,
+        help='parallel blender processes (default: cpu count)'
+    )
+    parser.add_argument(
+        '-b', '--blender',
+        default='blender',
+        type=str,
+        help='blender executable (default: blender)'
+    )
+    parser.add_argument(
+        '-p', '--preview',
+        dest='preview',
+        action='store_true',
+        help='preview (default: False)'
+    )
+    parser.add_argument(
+        '-t', '--thicc',
+        dest='thicc',
+        action='store_true',
+        help='extra thicc (default: False)'
+    )
+    parser.add_argument(
+        '-r', '--rig',
+        dest='rig',
+        action='store_true',
+        help='autorig (default: False)'
+    )
+    parser.add_argument(
+        '-c', '--vrc',
+        dest='vrc',
+        action='store_true',
+        help='optimize for vrc (default: False)'
+    )
+    args = parser.parse_args()
+
+    flags = [
+        flag for flag, enabled in (
+            ('-p', args.preview),
+            ('-t', args.thicc),
+            ('-r', args.rig),
+            ('-c', args.vrc),
+        ) if enabled
+    ]
+
+    # the same file listed twice is built once
+    inputs = list(dict.fromkeys(os.path.abspath(i) for i in args.inputs))
+    for input in inputs:
+        if not os.path.exists(input):
+            parser.error("input file %s doesn't exist" % (input))
+
+    # one output directory per avatar, previews sit next to the fbx
+    outputs = {}
+    for input in inputs:
+        name = os.path.splitext(os.path.basename(input))[0]
+        if name in outputs:
+            parser.error(
+                "inputs %s and %s would both be written to %s" %
+                (outputs[name], input, os.path.join(args.output, name))
+            )
+        outputs[name] = input
+
+    # group the avatars by id, the groups run in parallel
+    groups = {}
+    for name, input in outputs.items():
+        output = os.path.join(args.output, name, name + '.fbx')
+        try:
+            id = getId(input)
+        except ValueError:
+            parser.error("input file %s isn't valid json" % (input))
+        groups.setdefault(id, []).append((input, output))
+
+    # the work happens in the blender processes, threads only wait on them
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        codes = [
+            code
+            for group in executor.map(
+                lambda jobs: buildAll(args.blender, jobs, flags),
+                groups.values()
+            )
+            for code in group
+        ]
+
+    sys.exit(1 if any(codes) else 0)